@@ -4,39 +4,258 @@ Multi-agent medical consultation system using LangGraph
 
 from langgraph.graph import StateGraph, END
 from langchain_core.runnables import RunnableLambda
-from typing import TypedDict, List, Optional, Dict, Any
+from langchain_core.prompts import PromptTemplate
+from typing import Tuple, List, Optional, Dict, Any, Literal, AsyncIterator
 from pydantic import BaseModel, Field
 from langchain_openai import ChatOpenAI
+from openai import AsyncOpenAI, RateLimitError
+from tenacity import retry, retry_if_exception_type, wait_exponential_jitter, stop_after_attempt
+from functools import lru_cache
+import httpx
+import tiktoken
 import os
 import asyncio
+import time
 import json
 from datetime import datetime
 import logging
+from dataclasses import dataclass, field
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+EMBEDDING_MODEL = "text-embedding-3-small"
+CHEAP_MODEL = "gpt-4o-mini"
+TRIAGE_MODEL = CHEAP_MODEL
+SUMMARY_MODEL = CHEAP_MODEL
+
+# 上一轮意见超过该 token 数时先压缩成摘要再广播给下一轮
+SUMMARY_TOKEN_THRESHOLD = 2000
+
+# Cap on in-flight expert calls, tuned to the account's rate limit
+_llm_sema = asyncio.Semaphore(int(os.getenv('OPENAI_MAX_CONCURRENCY', '8')))
+
+# 按问题复杂度决定专家人数和讨论轮数
+CONSULTATION_PLANS = {
+    "standard": {"expert_count": 5, "num_rounds": 2},
+    "complex": {"expert_count": 7, "num_rounds": 3},
+}
+DEFAULT_EXPERT_COUNT = 5
+DEFAULT_NUM_ROUNDS = 3
+# Recruit for the largest plan up front, before triage has picked one
+MAX_EXPERT_COUNT = max(plan["expert_count"] for plan in CONSULTATION_PLANS.values())
+
+# 会诊共享上下文的固定开头；放在每轮所有专家请求的最前面，便于命中 OpenAI 前缀缓存
+CONSULTATION_GUIDELINES = (
+    "这是一次多学科专家联合会诊。多位不同专科的医学专家将围绕同一个医疗问题分轮次讨论，"
+    "每一轮都能看到上一轮所有专家的意见，最后由主持人汇总形成会诊结论。\n"
+    "会诊规范：\n"
+    "1. 始终使用中文回答，使用规范的医学术语，必要时对术语做简短解释。\n"
+    "2. 从您本人的专科角度出发分析问题，说明您关注的关键症状、体征和危险因素。\n"
+    "3. 给出诊断时按可能性从高到低列出主要诊断和鉴别诊断，并说明支持和不支持的依据。\n"
+    "4. 建议的检查应说明目的，优先选择无创、经济且对鉴别诊断最有价值的项目。\n"
+    "5. 治疗建议需区分一般处理、药物治疗和转诊指征；涉及儿童、孕妇、老年人时注意剂量与禁忌。\n"
+    "6. 参考其他专家意见时，明确指出您同意或不同意的观点及理由，避免简单重复。\n"
+    "7. 如存在需要立即就医的危险信号，请明确提示。\n"
+    "8. 信息不足时说明还需要补充哪些病史或检查，不要编造未提供的检查结果。\n"
+    "9. 回答应条理清晰、重点突出，避免冗长。\n"
+    "10. 本会诊意见仅供参考，不能替代线下医生的面诊。"
+)
+
+# 提示词模板
+SHARED_CONTEXT_PROMPT = PromptTemplate.from_template("{guidelines}\n\n会诊问题：\n{question}")
+ASSESSMENT_SECTION_PROMPT = PromptTemplate.from_template("\n\n{title}：\n{assessment}")
+EXPERT_TURN_PROMPT = PromptTemplate.from_template("{persona}\n\n{instruction}")
+PERSONA_PROMPT = PromptTemplate.from_template("You are a {role}.\nInstructions: {instruction}")
+EXPERT_INSTRUCTION_PROMPT = PromptTemplate.from_template("You are a {role} who {description}. Please respond in Chinese.")
+
+INITIAL_ROUND_INSTRUCTION = "根据医疗问题，请给出您的专业意见和初步诊断。\n\n请用中文回答，格式如下：\n\n诊断意见："
+DISCUSSION_ROUND_INSTRUCTION = "请基于其他专家的意见，提供您的进一步分析和建议。\n\n请用中文回答："
+FINAL_ROUND_INSTRUCTION = "基于前面的讨论，请提供您的最终分析意见。\n\n请用中文回答："
+
+COUNCIL_PROMPT = PromptTemplate.from_template(
+    "For each of the following experts, give their independent Chinese diagnostic opinion on the question. "
+    "Each opinion must reflect only that expert's specialty, as if they had not seen the others. "
+    "Return one opinion per expert, using each role exactly as written.\n\n"
+    "Experts:\n{experts}"
+)
+
+SUMMARY_SYSTEM = "You condense medical expert opinions without losing diagnoses, key evidence or disagreements."
+SUMMARY_PROMPT = PromptTemplate.from_template(
+    "Question: {question}\n\nSummarize each expert's opinion in two Chinese sentences, keyed by the exact role.\n\nOpinions:\n{opinions}"
+)
+
+TRIAGE_SYSTEM = "You are a triage doctor who decides how much multidisciplinary discussion a medical question needs."
+TRIAGE_PROMPT = PromptTemplate.from_template(
+    "Question: {question}\n\n"
+    "Classify the question's complexity:\n"
+    "- trivial: a general medical knowledge question that a single general practitioner can answer reliably, with no individual patient to diagnose.\n"
+    "- standard: a typical clinical question about a patient that benefits from a few specialists.\n"
+    "- complex: multiple organ systems, rare or high-risk conditions, or conflicting findings.\n\n"
+    "Only when the question is trivial, also give a concise direct answer in Chinese as answer_if_trivial."
+)
+
+RECRUITMENT_SYSTEM = (
+    "You are an experienced medical expert who recruits a group of experts with diverse identities and asks them to discuss and solve the given medical query. "
+    "Please respond in Chinese for role names and descriptions."
+)
+RECRUITMENT_PROMPT = PromptTemplate.from_template(
+    "Question: {question}\n\n"
+    "You can recruit {expert_count} experts in different medical expertise. "
+    "Considering the medical question, what kind of experts will you recruit to better make an accurate answer?\n"
+    "Also, you need to specify the communication structure between experts (e.g., 呼吸科专家 == 儿科专家 == 心脏科专家 > 全科医生), or indicate if they are independent.\n\n"
+    "For example, if you want to recruit five experts, your answer can be like:\n"
+    "1. 儿科医生 - 专门从事婴幼儿、儿童和青少年的医疗保健工作 - Hierarchy: Independent\n"
+    "2. 心脏科专家 - 专注于心脏和血管相关疾病的诊断和治疗 - Hierarchy: 儿科医生 > 心脏科专家\n"
+    "3. 呼吸科专家 - 专门诊断和治疗呼吸系统疾病 - Hierarchy: Independent\n"
+    "4. 新生儿科专家 - 专注于新生儿护理，特别是早产儿或有医疗问题的新生儿 - Hierarchy: Independent\n"
+    "5. 医学遗传专家 - 专门研究基因和遗传疾病 - Hierarchy: Independent\n\n"
+    "List the experts from most to least essential for this question.\n"
+    "Please answer in above format, with Chinese role names and descriptions, and do not include your reason."
+)
+
+MODERATOR_INSTRUCTION = "You are a final medical decision maker who reviews all opinions from different medical experts and makes final decision. Please respond in Chinese."
+DECISION_PROMPT = PromptTemplate.from_template(
+    "根据各位专家的最终意见，请综合分析并给出最终的医疗会诊结论。您的答案应该包含诊断结论、诊断依据、建议检查、治疗建议和注意事项。\n\n"
+    "各专家意见：\n{summary}\n\n问题：{question}\n\n请用中文给出详细的最终结论："
+)
+
+def build_shared_context(question: str, assessment: Optional[str] = None, assessment_title: str = "上一轮专家意见") -> str:
+    """Build the context shared verbatim by every expert in a round"""
+    context = SHARED_CONTEXT_PROMPT.format(guidelines=CONSULTATION_GUIDELINES, question=question)
+    if assessment:
+        context += ASSESSMENT_SECTION_PROMPT.format(title=assessment_title, assessment=assessment)
+    return context
+
+@lru_cache(maxsize=1)
+def get_http_client() -> httpx.AsyncClient:
+    """Shared HTTP/2 connection pool for every OpenAI call"""
+    return httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+        http2=True
+    )
+
+@lru_cache(maxsize=1)
+def get_async_client() -> AsyncOpenAI:
+    """Shared OpenAI client so concurrent experts reuse one HTTP/2 connection pool"""
+    return AsyncOpenAI(api_key=os.getenv('OPENAI_API_KEY'), http_client=get_http_client())
+
+@lru_cache(maxsize=8)
+def get_llm(model: str, temperature: Optional[float] = None) -> ChatOpenAI:
+    """Shared, stateless LangChain chat model per (model, temperature)"""
+    return ChatOpenAI(
+        model=model,
+        temperature=temperature,
+        api_key=os.getenv('OPENAI_API_KEY'),
+        http_async_client=get_http_client()
+    )
+
+async def embed_question(question: str) -> List[float]:
+    """Embed a consultation question for semantic answer caching"""
+    response = await get_async_client().embeddings.create(model=EMBEDDING_MODEL, input=question)
+    return response.data[0].embedding
+
+@lru_cache(maxsize=4)
+def _enc(model: str) -> tiktoken.Encoding:
+    """Tokenizer for a model, resolved once; raises (uncached) when it cannot be loaded"""
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+
+def count_tokens(text: str, model: str) -> int:
+    """Count prompt tokens with the model's tokenizer, falling back to a character count"""
+    try:
+        return len(_enc(model).encode(text))
+    except Exception as e:
+        logger.warning(f"Tokenizer unavailable for {model}: {str(e)}")
+        return len(text)
+
+async def warm_tokenizers(*models: str):
+    """Resolve tokenizers off the event loop (tiktoken may download its BPE file on first use)"""
+    for model in models:
+        try:
+            await asyncio.to_thread(_enc, model)
+        except Exception as e:
+            logger.warning(f"Tokenizer unavailable for {model}: {str(e)}")
+
+def format_opinions(opinions: Dict[str, str]) -> str:
+    """Serialize a round's opinions keyed by role"""
+    return json.dumps(opinions, ensure_ascii=False, indent=2)
+
+@retry(
+    retry=retry_if_exception_type(RateLimitError),
+    wait=wait_exponential_jitter(initial=1, max=30),
+    stop=stop_after_attempt(6),
+    reraise=True
+)
+async def _call_with_retry(client: AsyncOpenAI, **kwargs):
+    """Create a chat completion, backing off on rate limits"""
+    return await client.chat.completions.create(**kwargs)
+
 # 定义 Agent 类封装
 class Agent:
-    def __init__(self, instruction: str, role: str, model_info: str):
+    def __init__(self, instruction: str, role: str, model_info: str, client: Optional[AsyncOpenAI] = None):
         self.role = role
         self.instruction = instruction
         self.model_info = model_info
-        self.llm = ChatOpenAI(model=model_info, api_key=os.getenv('OPENAI_API_KEY'))
-        self.history = []  
-        
-    def chat(self, message: str) -> str:
-        try:
-            if not self.history:
-                self.history.append({"role": "system", "content": f"You are a {self.role}.\nInstructions: {self.instruction}"})
-            self.history.append({"role": "user", "content": message})
-            response = self.llm.invoke(self.history)
-            self.history.append({"role": "assistant", "content": response.content})
-            return response.content
-        except Exception as e:
-            logger.error(f"Error in {self.role} chat: {str(e)}")
-            return f"Error: Unable to get response from {self.role}"
+        self.client = client or get_async_client()
+        self.persona = PERSONA_PROMPT.format(role=role, instruction=instruction)
+    
+    async def astream_chat(self, messages: List[dict], model: Optional[str] = None) -> AsyncIterator[str]:
+        """Yield the reply to the caller's messages as content deltas"""
+        async with _llm_sema:
+            stream = await _call_with_retry(
+                self.client,
+                model=model or self.model_info,
+                messages=messages,
+                stream=True,
+                stream_options={"include_usage": True}
+            )
+            async for chunk in stream:
+                if chunk.usage is not None:
+                    details = getattr(chunk.usage, "prompt_tokens_details", None)
+                    if details is not None:
+                        logger.debug(f"{self.role}: {details.cached_tokens}/{chunk.usage.prompt_tokens} prompt tokens cached")
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+
+def round_messages(agent: Agent, shared_context: str, message: str) -> List[dict]:
+    """Messages for one round: the shared context first, the expert's persona in the trailing turn"""
+    return [
+        {"role": "system", "content": shared_context},
+        {"role": "user", "content": EXPERT_TURN_PROMPT.format(persona=agent.persona, instruction=message)}
+    ]
+
+async def stream_reply(agent: Agent, messages: List[dict], session_id: Optional[str], round_name: str,
+                       model: Optional[str] = None) -> str:
+    """Stream an agent's reply, forwarding each delta to the session, and return the full text"""
+    parts = []
+    async for delta in agent.astream_chat(messages, model):
+        parts.append(delta)
+        await publish_event(session_id, {"type": "token", "round": round_name, "role": agent.role, "delta": delta})
+    return "".join(parts)
+
+async def gather_replies(agents: Dict[str, Agent], shared_context: str, message: str, fallback: str,
+                         session_id: Optional[str] = None, round_name: str = "",
+                         model: Optional[str] = None) -> Tuple[Dict[str, str], List[str]]:
+    """Stream the same round prompt to every agent concurrently; returns replies by role and the roles that fell back"""
+    results = await asyncio.gather(
+        *(stream_reply(agent, round_messages(agent, shared_context, message), session_id, round_name, model)
+          for agent in agents.values()),
+        return_exceptions=True
+    )
+    replies = {}
+    failed = []
+    for role, result in zip(agents, results):
+        if isinstance(result, Exception):
+            logger.error(f"Error getting reply from {role}: {str(result)}")
+            replies[role] = fallback.format(role=role)
+            failed.append(role)
+        else:
+            replies[role] = result
+    return replies, failed
 
 # 结构化专家模型
 class ExpertAgent(BaseModel):
@@ -47,198 +266,270 @@ class ExpertAgent(BaseModel):
 class ExpertPlan(BaseModel):
     agents: List[ExpertAgent] = Field(description="List of recruited expert agents.")
 
+class ExpertOpinion(BaseModel):
+    role: str = Field(description="The expert's role, exactly as given.")
+    opinion: str = Field(description="The expert's independent Chinese diagnostic opinion.")
+
+class RoundOpinions(BaseModel):
+    opinions: List[ExpertOpinion] = Field(description="One opinion per expert.")
+
+class OpinionSummary(BaseModel):
+    role: str = Field(description="The expert's role, exactly as given.")
+    summary: str = Field(description="A two-sentence Chinese summary of the expert's opinion.")
+
+class RoundSummary(BaseModel):
+    summaries: List[OpinionSummary] = Field(description="One summary per expert.")
+
+class TriageResult(BaseModel):
+    complexity: Literal["trivial", "standard", "complex"] = Field(description="How much expert discussion the question needs.")
+    answer_if_trivial: Optional[str] = Field(default=None, description="A direct Chinese answer, only when the question is trivial.")
+
 # 工作流状态
-class WorkflowState(TypedDict):
+@dataclass(slots=True)
+class WorkflowState:
     question: str
-    model: str
-    agents_data: Optional[List[ExpertAgent]]
-    agent_dict: Optional[dict]
-    medical_agents: Optional[List]
-    round_opinions: Optional[dict]
-    final_answer: Optional[dict]
-    decision: Optional[str]
-    session_id: Optional[str]
-    progress: Optional[float]
-    current_step: Optional[str]
-    start_time: Optional[datetime]
-    end_time: Optional[datetime]
-
-# Progress callback function
-progress_callbacks = {}
-
-def set_progress_callback(session_id: str, callback):
-    """Set progress callback for a session"""
-    progress_callbacks[session_id] = callback
-
-def update_progress(session_id: str, progress: float, step: str):
-    """Update progress for a session"""
-    if session_id in progress_callbacks:
-        try:
-            progress_callbacks[session_id](progress, step)
-        except Exception as e:
-            logger.error(f"Error calling progress callback: {str(e)}")
+    cheap_model: str
+    strong_model: str
+    session_id: Optional[str] = None
+    agents_data: List[ExpertAgent] = field(default_factory=list)
+    agent_dict: Dict[str, Any] = field(default_factory=dict)
+    medical_agents: List[Any] = field(default_factory=list)
+    round_opinions: Dict[str, Dict[str, str]] = field(default_factory=dict)
+    round_summaries: Dict[str, Dict[str, str]] = field(default_factory=dict)
+    # Set when any expert or the moderator fell back to a placeholder answer
+    degraded: bool = False
+    decision: Optional[str] = None
+    num_rounds: int = DEFAULT_NUM_ROUNDS
+    progress: float = 0.0
+    current_step: str = ""
+    start_time: Optional[int] = None
+    end_time: Optional[int] = None
 
-# 1. 招募专家
-def recruit_agents(state: WorkflowState):
+def format_timestamp(ns: Optional[int]) -> Optional[str]:
+    """ISO string for an epoch-nanosecond timestamp, only when building a response"""
+    return datetime.fromtimestamp(ns / 1e9).isoformat() if ns else None
+
+def final_round(round_opinions: Dict[str, Dict[str, str]], num_rounds: int) -> Dict[str, str]:
+    """Opinions from the last debate round, which double as each expert's final answer"""
+    return round_opinions.get(str(num_rounds), {})
+
+# Progress queues, one per session
+progress_queues: Dict[str, asyncio.Queue] = {}
+
+def set_progress_queue(session_id: str, queue: asyncio.Queue):
+    """Set the queue that receives progress events for a session"""
+    progress_queues[session_id] = queue
+
+async def publish_event(session_id: Optional[str], event: dict):
+    """Put an event on a session's queue, if anyone is listening"""
+    queue = progress_queues.get(session_id)
+    if queue is not None:
+        await queue.put(event)
+
+async def update_progress(session_id: str, progress: float, step: str):
+    """Publish a progress event for a session"""
+    await publish_event(session_id, {"progress": progress, "current_step": step})
+
+# 一次调用生成所有专家的首轮意见
+async def council_opinions(question: str, agents_data: List[ExpertAgent], model: str) -> Dict[str, str]:
     try:
-        session_id = state.get("session_id")
-        update_progress(session_id, 10.0, "正在组建AI专家团队...")
+        structured_llm = get_llm(model).with_structured_output(RoundOpinions)
+        experts = "\n".join(f"- {agent.role}: {agent.description}" for agent in agents_data)
+        chat_messages = [
+            {"role": "system", "content": build_shared_context(question)},
+            {"role": "user", "content": COUNCIL_PROMPT.format(experts=experts)},
+        ]
+        result = await structured_llm.ainvoke(chat_messages)
+        return {item.role: item.opinion for item in result.opinions}
+    except Exception as e:
+        logger.error(f"Error collecting council opinions: {str(e)}")
+        return {}
+
+# 压缩一轮专家意见
+async def summarize_round(question: str, opinions: Dict[str, str]) -> Dict[str, str]:
+    try:
+        llm = get_llm(SUMMARY_MODEL, temperature=0)
+        structured_llm = llm.with_structured_output(RoundSummary)
+        chat_messages = [
+            {"role": "system", "content": SUMMARY_SYSTEM},
+            {"role": "user", "content": SUMMARY_PROMPT.format(question=question, opinions=format_opinions(opinions))},
+        ]
+        result = await structured_llm.ainvoke(chat_messages)
+        summaries = {item.role: item.summary for item in result.summaries}
+        # Keep the raw opinion for any expert the summary missed
+        return {role: summaries.get(role, opinion) for role, opinion in opinions.items()}
+    except Exception as e:
+        logger.error(f"Error summarizing round: {str(e)}")
+        return opinions
+
+async def build_assessment(question: str, opinions: Dict[str, str], model: str) -> Tuple[str, int, Optional[Dict[str, str]]]:
+    """Serialize a round's opinions for the next round, summarizing them first when too long"""
+    assessment = format_opinions(opinions)
+    tokens = await asyncio.to_thread(count_tokens, assessment, model)
+    if tokens <= SUMMARY_TOKEN_THRESHOLD:
+        return assessment, tokens, None
+    summaries = await summarize_round(question, opinions)
+    assessment = format_opinions(summaries)
+    return assessment, await asyncio.to_thread(count_tokens, assessment, model), summaries
+
+# 0. 分诊：评估问题复杂度
+async def triage(question: str, session_id: str = None) -> Optional[TriageResult]:
+    try:
+        await update_progress(session_id, 5.0, "正在评估问题复杂度...")
         
-        llm = ChatOpenAI(model=state["model"], api_key=os.getenv('OPENAI_API_KEY'))
-        structured_llm = llm.with_structured_output(ExpertPlan)
-        system_instruction = (
-            "You are an experienced medical expert who recruits a group of experts with diverse identities and asks them to discuss and solve the given medical query. "
-            "Please respond in Chinese for role names and descriptions."
-        )
-        expert_count = 5
-        recruitment_task_prompt = (
-            f"Question: {state['question']}\n\n"
-            f"You can recruit {expert_count} experts in different medical expertise. "
-            "Considering the medical question, what kind of experts will you recruit to better make an accurate answer?\n"
-            "Also, you need to specify the communication structure between experts (e.g., 呼吸科专家 == 儿科专家 == 心脏科专家 > 全科医生), or indicate if they are independent.\n\n"
-            "For example, if you want to recruit five experts, your answer can be like:\n"
-            "1. 儿科医生 - 专门从事婴幼儿、儿童和青少年的医疗保健工作 - Hierarchy: Independent\n"
-            "2. 心脏科专家 - 专注于心脏和血管相关疾病的诊断和治疗 - Hierarchy: 儿科医生 > 心脏科专家\n"
-            "3. 呼吸科专家 - 专门诊断和治疗呼吸系统疾病 - Hierarchy: Independent\n"
-            "4. 新生儿科专家 - 专注于新生儿护理，特别是早产儿或有医疗问题的新生儿 - Hierarchy: Independent\n"
-            "5. 医学遗传专家 - 专门研究基因和遗传疾病 - Hierarchy: Independent\n\n"
-            "Please answer in above format, with Chinese role names and descriptions, and do not include your reason."
-        )
+        llm = get_llm(TRIAGE_MODEL)
+        structured_llm = llm.with_structured_output(TriageResult)
         chat_messages = [
-            {"role": "system", "content": system_instruction},
-            {"role": "user", "content": recruitment_task_prompt},
+            {"role": "system", "content": TRIAGE_SYSTEM},
+            {"role": "user", "content": TRIAGE_PROMPT.format(question=question)},
         ]
         
-        plan = structured_llm.invoke(chat_messages)
-        update_progress(session_id, 25.0, "专家团队组建完毕，正在初始化...")
+        return await structured_llm.ainvoke(chat_messages)
+    except Exception as e:
+        logger.error(f"Error triaging question: {str(e)}")
+        return None
+
+# 1. 招募专家
+async def recruit_experts(question: str, model: str, expert_count: int) -> List[ExpertAgent]:
+    try:
+        llm = get_llm(model)
+        structured_llm = llm.with_structured_output(ExpertPlan)
+        chat_messages = [
+            {"role": "system", "content": RECRUITMENT_SYSTEM},
+            {"role": "user", "content": RECRUITMENT_PROMPT.format(question=question, expert_count=expert_count)},
+        ]
         
-        return {"agents_data": plan.agents}
+        plan = await structured_llm.ainvoke(chat_messages)
+        return plan.agents
     except Exception as e:
         logger.error(f"Error recruiting agents: {str(e)}")
-        return {"agents_data": []}
+        return []
 
 # 2. 初始化专家对象
-def init_agents(state: WorkflowState):
+async def init_agents(state: WorkflowState):
     try:
-        session_id = state.get("session_id")
-        update_progress(session_id, 30.0, "正在初始化专家...")
+        session_id = state.session_id
+        await update_progress(session_id, 30.0, "正在初始化专家...")
         
         agents = []
         agent_dict = {}
-        for agent in state["agents_data"]:
+        for agent in state.agents_data:
             role = agent.role
             desc = agent.description
-            agent_obj = Agent(f"You are a {role} who {desc}. Please respond in Chinese.", role, model_info=state['model'])
+            agent_obj = Agent(EXPERT_INSTRUCTION_PROMPT.format(role=role, description=desc), role, model_info=state.cheap_model)
             agent_dict[role] = agent_obj
             agents.append(agent_obj)
         
-        update_progress(session_id, 35.0, "专家初始化完成，开始收集意见...")
+        await update_progress(session_id, 35.0, "专家初始化完成，开始收集意见...")
         return {"agent_dict": agent_dict, "medical_agents": agents}
     except Exception as e:
         logger.error(f"Error initializing agents: {str(e)}")
         return {"agent_dict": {}, "medical_agents": []}
 
 # 3. 专家辩论与意见收集
-def collect_opinions(state: WorkflowState):
+async def collect_opinions(state: WorkflowState):
     try:
-        session_id = state.get("session_id")
-        question = state['question']
-        medical_agents = state['medical_agents']
-        agent_dict = state['agent_dict']
+        session_id = state.session_id
+        question = state.question
+        agent_dict = state.agent_dict
         
         # Simplified debate process for faster execution
-        num_rounds = 3  # Reduced from 5
+        num_rounds = state.num_rounds
         round_opinions = {str(n): {} for n in range(1, num_rounds+1)}
+        round_summaries = {}
+        failed = []
         
-        # Round 1: Initial Opinions
-        update_progress(session_id, 40.0, "专家们正在进行第一轮意见收集...")
-        for role, agent in agent_dict.items():
-            try:
-                opinion = agent.chat(f'根据医疗问题，请给出您的专业意见和初步诊断。\n\n问题: {question}\n\n请用中文回答，格式如下：\n\n诊断意见：')
-                round_opinions["1"][role] = opinion
-            except Exception as e:
-                logger.error(f"Error getting opinion from {role}: {str(e)}")
-                round_opinions["1"][role] = f"专家 {role} 暂时无法提供意见"
+        # Round 1: Initial Opinions, from a single council call
+        await update_progress(session_id, 40.0, "专家们正在进行第一轮意见收集...")
+        council = await council_opinions(question, state.agents_data, state.cheap_model)
+        for role, opinion in council.items():
+            if role in agent_dict:
+                await publish_event(session_id, {"type": "token", "round": "1", "role": role, "delta": opinion})
         
-        # Round 2: Discussion
-        update_progress(session_id, 60.0, "专家们正在进行第二轮讨论...")
-        if len(round_opinions["1"]) > 0:
-            assessment = "\n".join(f"{k}: {v}" for k, v in round_opinions["1"].items())
-            for role, agent in agent_dict.items():
-                try:
-                    opinion = agent.chat(f'请基于其他专家的意见，提供您的进一步分析和建议。\n\n其他专家意见：\n{assessment}\n\n请用中文回答：')
-                    round_opinions["2"][role] = opinion
-                except Exception as e:
-                    logger.error(f"Error in round 2 for {role}: {str(e)}")
-                    round_opinions["2"][role] = f"专家 {role} 在第二轮讨论中无法提供意见"
+        # Ask any expert the council call missed individually
+        missing = {role: agent for role, agent in agent_dict.items() if not council.get(role)}
+        fallback_opinions = {}
+        if missing:
+            fallback_opinions, round_failed = await gather_replies(
+                missing,
+                build_shared_context(question),
+                INITIAL_ROUND_INSTRUCTION,
+                "专家 {role} 暂时无法提供意见",
+                session_id,
+                "1"
+            )
+            failed += round_failed
+        round_opinions["1"] = {role: council.get(role) or fallback_opinions[role] for role in agent_dict}
         
-        # Round 3: Final discussion
-        update_progress(session_id, 70.0, "专家们正在进行最终讨论...")
-        if len(round_opinions["2"]) > 0:
-            assessment = "\n".join(f"{k}: {v}" for k, v in round_opinions["2"].items())
-            for role, agent in agent_dict.items():
-                try:
-                    opinion = agent.chat(f'基于前两轮讨论，请提供您的最终分析意见。\n\n讨论总结：\n{assessment}\n\n请用中文回答：')
-                    round_opinions["3"][role] = opinion
-                except Exception as e:
-                    logger.error(f"Error in round 3 for {role}: {str(e)}")
-                    round_opinions["3"][role] = f"专家 {role} 在最终讨论中无法提供意见"
+        # Middle rounds discuss on the cheap model, the last round gives final analysis on the strong one
+        for n in range(2, num_rounds + 1):
+            previous = round_opinions[str(n - 1)]
+            if len(previous) == 0:
+                break
+            round_model = state.strong_model if n == num_rounds else state.cheap_model
+            # Tokenized once per round; every expert shares the same assessment
+            assessment, assessment_tokens, summaries = await build_assessment(question, previous, round_model)
+            logger.debug(f"Round {n} assessment: {assessment_tokens} tokens shared by {len(agent_dict)} experts")
+            if summaries is not None:
+                round_summaries[str(n - 1)] = summaries
+            progress = 40.0 + 30.0 * (n - 1) / (num_rounds - 1)
+            if n < num_rounds:
+                await update_progress(session_id, progress, f"专家们正在进行第{n}轮讨论...")
+                round_opinions[str(n)], round_failed = await gather_replies(
+                    agent_dict,
+                    build_shared_context(question, assessment, "其他专家意见"),
+                    DISCUSSION_ROUND_INSTRUCTION,
+                    f"专家 {{role}} 在第{n}轮讨论中无法提供意见",
+                    session_id,
+                    str(n)
+                )
+            else:
+                await update_progress(session_id, progress, "专家们正在进行最终讨论...")
+                round_opinions[str(n)], round_failed = await gather_replies(
+                    agent_dict,
+                    build_shared_context(question, assessment, "讨论总结"),
+                    FINAL_ROUND_INSTRUCTION,
+                    "专家 {role} 在最终讨论中无法提供意见",
+                    session_id,
+                    str(n),
+                    round_model
+                )
+            failed += round_failed
         
-        return {"round_opinions": round_opinions}
+        return {"round_opinions": round_opinions, "round_summaries": round_summaries, "degraded": bool(failed)}
     except Exception as e:
         logger.error(f"Error collecting opinions: {str(e)}")
-        return {"round_opinions": {}}
+        return {"round_opinions": {}, "round_summaries": {}, "degraded": True}
 
-# 4. 汇总每个专家的最终决策
-def finalize_per_agent(state: WorkflowState):
+# 4. 主持人最终决策
+async def finalize_decision(state: WorkflowState):
     try:
-        session_id = state.get("session_id")
-        update_progress(session_id, 80.0, "正在汇总各专家最终意见...")
-        
-        final_answers = {}
-        for agent in state['medical_agents']:
-            try:
-                response = agent.chat(f"现在您已经与其他医疗专家进行了讨论，请结合您的专业知识和其他专家的意见，对以下问题给出最终答案：\n{state['question']}\n\n请用中文回答，包含诊断和建议：")
-                final_answers[agent.role] = response
-            except Exception as e:
-                logger.error(f"Error getting final answer from {agent.role}: {str(e)}")
-                final_answers[agent.role] = f"专家 {agent.role} 无法提供最终意见"
+        session_id = state.session_id
+        await update_progress(session_id, 90.0, "正在生成最终会诊结论...")
         
-        return {"final_answer": final_answers}
-    except Exception as e:
-        logger.error(f"Error finalizing per agent: {str(e)}")
-        return {"final_answer": {}}
-
-# 5. 主持人最终决策
-def finalize_decision(state: WorkflowState):
-    try:
-        session_id = state.get("session_id")
-        update_progress(session_id, 90.0, "正在生成最终会诊结论...")
+        summary = "\n".join(f"{k}: {v}" for k, v in final_round(state.round_opinions, state.num_rounds).items())
+        mod = Agent(MODERATOR_INSTRUCTION, "主持人", model_info=state.strong_model)
         
-        summary = "\n".join(f"{k}: {v}" for k, v in state['final_answer'].items())
-        mod = Agent("You are a final medical decision maker who reviews all opinions from different medical experts and makes final decision. Please respond in Chinese.", "主持人", model_info=state['model'])
+        decision = await stream_reply(mod, [
+            {"role": "system", "content": mod.persona},
+            {"role": "user", "content": DECISION_PROMPT.format(summary=summary, question=state.question)}
+        ], session_id, "decision")
         
-        decision = mod.chat(f"根据各位专家的最终意见，请综合分析并给出最终的医疗会诊结论。您的答案应该包含诊断结论、诊断依据、建议检查、治疗建议和注意事项。\n\n各专家意见：\n{summary}\n\n问题：{state['question']}\n\n请用中文给出详细的最终结论：")
-        
-        update_progress(session_id, 100.0, "会诊完成！")
-        return {"decision": decision, "end_time": datetime.now()}
+        await update_progress(session_id, 100.0, "会诊完成！")
+        return {"decision": decision, "end_time": time.time_ns()}
     except Exception as e:
         logger.error(f"Error finalizing decision: {str(e)}")
-        return {"decision": "由于系统问题，无法生成最终结论", "end_time": datetime.now()}
+        return {"decision": "由于系统问题，无法生成最终结论", "end_time": time.time_ns(), "degraded": True}
 
 # 构建医疗会诊 LangGraph 流程
 def create_medical_consultation_graph():
     medical_graph = StateGraph(WorkflowState)
-    medical_graph.add_node("recruit", RunnableLambda(recruit_agents))
     medical_graph.add_node("init_agents", RunnableLambda(init_agents))
     medical_graph.add_node("collect_opinions", RunnableLambda(collect_opinions))
-    medical_graph.add_node("finalize_per_agent", RunnableLambda(finalize_per_agent))
     medical_graph.add_node("finalize", RunnableLambda(finalize_decision))
-    medical_graph.set_entry_point("recruit")
-    medical_graph.add_edge("recruit", "init_agents")
+    medical_graph.set_entry_point("init_agents")
     medical_graph.add_edge("init_agents", "collect_opinions")
-    medical_graph.add_edge("collect_opinions", "finalize_per_agent")
-    medical_graph.add_edge("finalize_per_agent", "finalize")
+    medical_graph.add_edge("collect_opinions", "finalize")
     medical_graph.set_finish_point("finalize")
     
     return medical_graph.compile()
@@ -249,23 +540,60 @@ async def run_medical_consultation(question: str, model: str = "gpt-4o-mini", se
     Run medical consultation workflow
     """
     try:
+        start_time = time.time_ns()
+        
+        # Recruit speculatively while triaging; the panel is trimmed to the chosen plan afterwards
+        recruitment = asyncio.create_task(recruit_experts(question, model, MAX_EXPERT_COUNT))
+        try:
+            triage_result = await triage(question, session_id)
+        except BaseException:
+            recruitment.cancel()
+            raise
+        
+        # Answer trivial questions directly instead of convening the panel
+        complexity = triage_result.complexity if triage_result else None
+        if complexity == "trivial" and triage_result.answer_if_trivial:
+            recruitment.cancel()
+            end_time = time.time_ns()
+            await update_progress(session_id, 100.0, "会诊完成！")
+            return {
+                "session_id": session_id,
+                "question": question,
+                "experts": [],
+                "round_opinions": {},
+                "final_answers": {},
+                "decision": triage_result.answer_if_trivial,
+                "complexity": complexity,
+                "degraded": False,
+                "duration": (end_time - start_time) / 1e9,
+                "start_time": format_timestamp(start_time),
+                "end_time": format_timestamp(end_time)
+            }
+        
+        await update_progress(session_id, 10.0, "正在组建AI专家团队...")
+        recruited = await recruitment
+        await update_progress(session_id, 25.0, "专家团队组建完毕，正在初始化...")
+        
         graph = create_medical_consultation_graph()
         
-        initial_state = {
-            "question": question,
-            "model": model,
-            "session_id": session_id,
-            "start_time": datetime.now(),
-            "progress": 0.0,
-            "current_step": "开始会诊..."
-        }
+        plan = CONSULTATION_PLANS.get(complexity, {})
+        initial_state = WorkflowState(
+            question=question,
+            cheap_model=CHEAP_MODEL,
+            strong_model=model,
+            session_id=session_id,
+            agents_data=recruited[:plan.get("expert_count", DEFAULT_EXPERT_COUNT)],
+            num_rounds=plan.get("num_rounds", DEFAULT_NUM_ROUNDS),
+            start_time=start_time,
+            current_step="开始会诊..."
+        )
         
         # Execute the graph
         result = await graph.ainvoke(initial_state)
         
         # Calculate duration
         if result.get("start_time") and result.get("end_time"):
-            duration = (result["end_time"] - result["start_time"]).total_seconds()
+            duration = (result["end_time"] - result["start_time"]) / 1e9
         else:
             duration = 0
         
@@ -274,13 +602,15 @@ async def run_medical_consultation(question: str, model: str = "gpt-4o-mini", se
             "session_id": session_id,
             "question": question,
             "experts": [{"role": agent.role, "description": agent.description, "hierarchy": agent.hierarchy} 
-                       for agent in result.get("agents_data", [])],
-            "round_opinions": result.get("round_opinions", {}),
-            "final_answers": result.get("final_answer", {}),
-            "decision": result.get("decision", "无法生成结论"),
+                       for agent in result["agents_data"]],
+            "round_opinions": result["round_opinions"],
+            "final_answers": final_round(result["round_opinions"], result["num_rounds"]),
+            "decision": result["decision"] or "无法生成结论",
+            "complexity": complexity,
+            "degraded": result["degraded"] or not result["decision"],
             "duration": duration,
-            "start_time": result.get("start_time").isoformat() if result.get("start_time") else None,
-            "end_time": result.get("end_time").isoformat() if result.get("end_time") else None
+            "start_time": format_timestamp(result.get("start_time")),
+            "end_time": format_timestamp(result.get("end_time"))
         }
         
         return response
@@ -294,6 +624,7 @@ async def run_medical_consultation(question: str, model: str = "gpt-4o-mini", se
             "round_opinions": {},
             "final_answers": {},
             "decision": f"系统错误：{str(e)}",
+            "degraded": True,
             "duration": 0,
             "start_time": None,
             "end_time": None
@@ -302,5 +633,5 @@ async def run_medical_consultation(question: str, model: str = "gpt-4o-mini", se
 # 清理会话回调
 def cleanup_session(session_id: str):
     """Clean up session data"""
-    if session_id in progress_callbacks:
-        del progress_callbacks[session_id]
\ No newline at end of file
+    if session_id in progress_queues:
+        del progress_queues[session_id]
\ No newline at end of file
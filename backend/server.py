@@ -1,36 +1,55 @@
 from fastapi import FastAPI, APIRouter, BackgroundTasks
-from fastapi.responses import StreamingResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument
+from redis.asyncio import Redis
 import os
 import logging
 import json
 import asyncio
 from pathlib import Path
 from pydantic import BaseModel, Field
-from typing import List, Optional
+from typing import Any, Dict, List, Optional
 import uuid
-from datetime import datetime
+import time
+import itertools
+from datetime import datetime, timedelta, timezone
+import numpy as np
 
-# Import medical consultation module
 import sys
 import os
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
-from medical_consultation import (
-    run_medical_consultation, 
-    set_progress_callback, 
-    cleanup_session
-)
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
+# Import medical consultation module (after .env is loaded, it reads settings at import time)
+from medical_consultation import (
+    run_medical_consultation, 
+    set_progress_queue, 
+    cleanup_session,
+    embed_question,
+    get_async_client,
+    warm_tokenizers,
+    CHEAP_MODEL
+)
+
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
 client = AsyncIOMotorClient(mongo_url)
 db = client[os.environ['DB_NAME']]
 
+# Redis connection, the source of truth for live consultation state
+redis_client = Redis.from_url(os.environ['REDIS_URL'], decode_responses=True)
+
+# Semantic answer cache settings
+ANSWER_CACHE_THRESHOLD = float(os.environ.get('ANSWER_CACHE_THRESHOLD', '0.93'))
+ANSWER_CACHE_TTL = int(os.environ.get('ANSWER_CACHE_TTL', '86400'))
+# Entries are stamped before their upsert commits, so each sync re-reads this window to catch late commits
+ANSWER_INDEX_SYNC_OVERLAP = timedelta(seconds=60)
+
 # Create the main app without a prefix
 app = FastAPI()
 
@@ -54,6 +73,9 @@ class ConsultationRequest(BaseModel):
     question: str
     model: str = "gpt-4o-mini"
 
+class ConsultationBatchRequest(BaseModel):
+    items: List[ConsultationRequest]
+
 class ConsultationResponse(BaseModel):
     session_id: str
     question: str
@@ -65,8 +87,203 @@ class ConsultationResponse(BaseModel):
     start_time: Optional[str] = None
     end_time: Optional[str] = None
 
-# Store active consultations
-active_consultations = {}
+TERMINAL_STATUSES = ("completed", "error")
+
+# Session ids: a per-process node id plus a counter, unique across workers without a uuid per request
+_node_id = uuid.uuid4().hex[:8]
+_session_counter = itertools.count()
+
+def new_session_id() -> str:
+    return f"{_node_id}-{next(_session_counter):x}"
+
+# How long live session state is kept in Redis
+SESSION_TTL = 3600
+COMPLETED_SESSION_TTL = 300
+
+def session_key(session_id: str) -> str:
+    return f"session:{session_id}"
+
+def events_channel(session_id: str) -> str:
+    return f"session:{session_id}:events"
+
+def consultation_snapshot(session_id: str, consultation: dict) -> dict:
+    """Public view of a consultation's state"""
+    return {
+        "session_id": session_id,
+        "status": consultation["status"],
+        "progress": consultation["progress"],
+        "current_step": consultation["current_step"],
+        "result": consultation.get("result")
+    }
+
+def encode_session_fields(fields: dict) -> dict:
+    """Flatten consultation fields into Redis hash values"""
+    return {k: json.dumps(v) if k == "result" else v for k, v in fields.items()}
+
+def decode_session(raw: dict) -> Optional[dict]:
+    """Turn a Redis consultation hash back into typed fields"""
+    if not raw:
+        return None
+    consultation = dict(raw)
+    consultation["progress"] = float(raw.get("progress", 0.0))
+    consultation["start_time"] = int(raw["start_time"]) if raw.get("start_time") else None
+    consultation["result"] = json.loads(raw["result"]) if raw.get("result") else None
+    return consultation
+
+async def load_session(session_id: str) -> Optional[dict]:
+    """Read a live consultation from Redis"""
+    return decode_session(await redis_client.hgetall(session_key(session_id)))
+
+async def load_sessions(session_ids: List[str]) -> List[Optional[dict]]:
+    """Read several live consultations from Redis in one round trip"""
+    async with redis_client.pipeline(transaction=False) as pipe:
+        for session_id in session_ids:
+            pipe.hgetall(session_key(session_id))
+        raws = await pipe.execute()
+    return [decode_session(raw) for raw in raws]
+
+async def publish_update(session_id: str, update: dict):
+    """Apply an update to the consultation in Redis and publish the new state to SSE subscribers"""
+    key = session_key(session_id)
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.hset(key, mapping=encode_session_fields(update))
+        # Refresh the TTL on every write so a long run never recreates the key without one
+        pipe.expire(key, COMPLETED_SESSION_TTL if update.get("status") in TERMINAL_STATUSES else SESSION_TTL)
+        await pipe.execute()
+    consultation = await load_session(session_id)
+    if consultation is not None:
+        await redis_client.publish(events_channel(session_id), json.dumps(consultation_snapshot(session_id, consultation)))
+
+async def relay_progress(session_id: str, queue: asyncio.Queue):
+    """Forward workflow events to Redis until a None sentinel; token deltas are published but not stored"""
+    while True:
+        event = await queue.get()
+        if event is None:
+            break
+        try:
+            if event.get("type") == "token":
+                await redis_client.publish(events_channel(session_id), json.dumps({"session_id": session_id, **event}))
+            else:
+                await publish_update(session_id, event)
+        except Exception as e:
+            logger.error(f"Error publishing progress for {session_id}: {str(e)}")
+
+async def save_consultation_record(session_id: str, end_time: int):
+    """Write the finished consultation from Redis to the database once (timestamps in epoch ns)"""
+    consultation = await load_session(session_id)
+    if consultation is None:
+        return
+    consultation["end_time"] = end_time
+    await db.consultations.update_one({"session_id": session_id}, {"$set": consultation}, upsert=True)
+
+async def embed_question_safely(question: str) -> Optional[List[float]]:
+    """Embed a question, returning None so cache failures never block a consultation"""
+    try:
+        return await embed_question(question)
+    except Exception as e:
+        logger.error(f"Error embedding question: {str(e)}")
+        return None
+
+def epoch_seconds(ts: datetime) -> float:
+    """Seconds since the epoch for a naive UTC datetime as stored in Mongo"""
+    return ts.replace(tzinfo=timezone.utc).timestamp()
+
+class AnswerIndex:
+    """In-process matrix of normalized cached-question embeddings, one per model"""
+    def __init__(self):
+        self.ids: Dict[str, list] = {}
+        self.rows: Dict[str, Dict[Any, int]] = {}
+        self.matrix: Dict[str, np.ndarray] = {}
+        self.ts: Dict[str, np.ndarray] = {}
+        self.synced_until: Optional[datetime] = None
+    
+    def add(self, doc_id, model: str, embedding: List[float], ts: datetime):
+        """Add an entry, or replace it when the same cache document was stored again"""
+        vector = np.asarray(embedding, dtype=np.float32)
+        vector /= np.linalg.norm(vector) + 1e-12
+        rows = self.rows.setdefault(model, {})
+        if doc_id in rows:
+            row = rows[doc_id]
+            self.matrix[model][row] = vector
+            self.ts[model][row] = epoch_seconds(ts)
+        else:
+            rows[doc_id] = len(rows)
+            self.ids.setdefault(model, []).append(doc_id)
+            self.matrix[model] = np.vstack([self.matrix[model], vector]) if model in self.matrix else vector[None, :]
+            self.ts[model] = np.append(self.ts.get(model, np.empty(0)), epoch_seconds(ts))
+    
+    def prune(self, cutoff: datetime):
+        """Drop entries the TTL index has expired"""
+        limit = epoch_seconds(cutoff)
+        for model in list(self.matrix):
+            keep = self.ts[model] >= limit
+            if keep.all():
+                continue
+            self.ids[model] = [doc_id for doc_id, kept in zip(self.ids[model], keep) if kept]
+            self.rows[model] = {doc_id: row for row, doc_id in enumerate(self.ids[model])}
+            self.matrix[model] = self.matrix[model][keep]
+            self.ts[model] = self.ts[model][keep]
+    
+    def search(self, model: str, embedding: List[float]) -> Optional[tuple]:
+        """Most similar cached entry for a model as (document id, cosine similarity)"""
+        if not self.ids.get(model):
+            return None
+        query = np.asarray(embedding, dtype=np.float32)
+        scores = self.matrix[model] @ (query / (np.linalg.norm(query) + 1e-12))
+        best = int(np.argmax(scores))
+        return self.ids[model][best], float(scores[best])
+
+answer_index = AnswerIndex()
+
+async def sync_answer_index():
+    """Load cache entries written since the last sync (by this or another worker) and drop expired ones;
+    entries re-read from the overlap window replace their existing rows"""
+    cutoff = datetime.utcnow() - timedelta(seconds=ANSWER_CACHE_TTL)
+    since = max(answer_index.synced_until - ANSWER_INDEX_SYNC_OVERLAP, cutoff) if answer_index.synced_until else cutoff
+    entries = await db.answer_cache.find(
+        {"ts": {"$gt": since}},
+        {"embedding": 1, "model": 1, "ts": 1}
+    ).to_list(None)
+    for entry in entries:
+        answer_index.add(entry["_id"], entry["model"], entry["embedding"], entry["ts"])
+    if entries:
+        answer_index.synced_until = max(entry["ts"] for entry in entries)
+    answer_index.prune(cutoff)
+
+async def lookup_cached_answer(embedding: List[float], model: str) -> Optional[dict]:
+    """Return the cached result of the most similar previous question, if similar enough"""
+    try:
+        await sync_answer_index()
+        match = answer_index.search(model, embedding)
+        if match is None or match[1] < ANSWER_CACHE_THRESHOLD:
+            return None
+        
+        cached = await db.answer_cache.find_one({"_id": match[0]}, {"result": 1})
+        return cached["result"] if cached else None
+    except Exception as e:
+        logger.error(f"Error looking up answer cache: {str(e)}")
+        return None
+
+async def store_cached_answer(embedding: List[float], question: str, model: str, result: dict):
+    """Upsert a finished consultation into the answer cache and the in-process index"""
+    try:
+        ts = datetime.utcnow()
+        stored = await db.answer_cache.find_one_and_update(
+            {"question": question, "model": model},
+            {"$set": {
+                "embedding": embedding,
+                "question": question,
+                "model": model,
+                "result": result,
+                "ts": ts
+            }},
+            projection={"_id": 1},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        answer_index.add(stored["_id"], model, embedding, ts)
+    except Exception as e:
+        logger.error(f"Error storing answer cache: {str(e)}")
 
 # Add your routes to the router instead of directly to app
 @api_router.get("/")
@@ -85,60 +302,104 @@ async def get_status_checks():
     status_checks = await db.status_checks.find().to_list(1000)
     return [StatusCheck(**status_check) for status_check in status_checks]
 
+async def start_session(request: ConsultationRequest, background_tasks: BackgroundTasks) -> dict:
+    """Register a consultation and schedule it, or answer it from the cache"""
+    session_id = new_session_id()
+    
+    # Store consultation request
+    consultation_data = {
+        "session_id": session_id,
+        "question": request.question,
+        "model": request.model,
+        "status": "processing",
+        "progress": 0.0,
+        "current_step": "开始会诊...",
+        "start_time": time.time_ns(),
+        "result": None
+    }
+    
+    # Serve near-duplicate questions straight from the answer cache
+    embedding = await embed_question_safely(request.question)
+    cached_result = await lookup_cached_answer(embedding, request.model) if embedding else None
+    if cached_result:
+        consultation_data.update({
+            "status": "completed",
+            "progress": 100.0,
+            "current_step": "会诊完成！",
+            "result": {**cached_result, "session_id": session_id, "question": request.question,
+                       "duration": 0.0, "cached": True}
+        })
+    
+    key = session_key(session_id)
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.hset(key, mapping=encode_session_fields(consultation_data))
+        pipe.expire(key, COMPLETED_SESSION_TTL if cached_result else SESSION_TTL)
+        await pipe.execute()
+    
+    if cached_result:
+        await save_consultation_record(session_id, time.time_ns())
+        return {"session_id": session_id, "status": "started", "cached": True}
+    
+    # Start consultation in background
+    background_tasks.add_task(process_consultation, session_id, request.question, request.model, embedding)
+    
+    return {"session_id": session_id, "status": "started"}
+
 @api_router.post("/consultation/start")
 async def start_consultation(request: ConsultationRequest, background_tasks: BackgroundTasks):
     """Start a new medical consultation"""
     try:
-        session_id = str(uuid.uuid4())
-        
-        # Store consultation request
-        consultation_data = {
-            "session_id": session_id,
-            "question": request.question,
-            "model": request.model,
-            "status": "processing",
-            "progress": 0.0,
-            "current_step": "开始会诊...",
-            "start_time": datetime.now(),
-            "result": None
-        }
-        
-        active_consultations[session_id] = consultation_data
-        await db.consultations.insert_one(consultation_data)
-        
-        # Start consultation in background
-        background_tasks.add_task(process_consultation, session_id, request.question, request.model)
-        
-        return {"session_id": session_id, "status": "started"}
-        
+        return await start_session(request, background_tasks)
     except Exception as e:
         logger.error(f"Error starting consultation: {str(e)}")
         return {"error": str(e)}, 500
 
+@api_router.post("/consultation/start_batch")
+async def start_consultation_batch(request: ConsultationBatchRequest, background_tasks: BackgroundTasks):
+    """Start several medical consultations in one request"""
+    started = await asyncio.gather(
+        *(start_session(item, background_tasks) for item in request.items),
+        return_exceptions=True
+    )
+    errors = [item for item in started if isinstance(item, Exception)]
+    if not errors:
+        return {"session_ids": [item["session_id"] for item in started]}
+    
+    # Report the sessions that did start (they keep running) alongside the failure, by item position
+    logger.error(f"Error starting consultation batch: {str(errors[0])}")
+    return JSONResponse(status_code=500, content={
+        "error": str(errors[0]),
+        "session_ids": [None if isinstance(item, Exception) else item["session_id"] for item in started]
+    })
+
+@api_router.get("/consultation/progress")
+async def get_consultations_progress(ids: str):
+    """Get the progress of several consultations, keyed by session id"""
+    try:
+        session_ids = [session_id for session_id in ids.split(",") if session_id]
+        consultations = await load_sessions(session_ids)
+        progress = {}
+        for session_id, consultation in zip(session_ids, consultations):
+            if consultation is None:
+                consultation = await db.consultations.find_one({"session_id": session_id})
+            progress[session_id] = consultation_snapshot(session_id, consultation) if consultation else {"error": "Session not found"}
+        return progress
+    except Exception as e:
+        logger.error(f"Error getting consultations progress: {str(e)}")
+        return JSONResponse(status_code=500, content={"error": str(e)})
+
 @api_router.get("/consultation/{session_id}/progress")
 async def get_consultation_progress(session_id: str):
     """Get consultation progress"""
     try:
-        if session_id in active_consultations:
-            consultation = active_consultations[session_id]
-            return {
-                "session_id": session_id,
-                "status": consultation["status"],
-                "progress": consultation["progress"],
-                "current_step": consultation["current_step"],
-                "result": consultation.get("result")
-            }
+        consultation = await load_session(session_id)
+        if consultation is not None:
+            return consultation_snapshot(session_id, consultation)
         else:
             # Try to get from database
             consultation = await db.consultations.find_one({"session_id": session_id})
             if consultation:
-                return {
-                    "session_id": session_id,
-                    "status": consultation["status"],
-                    "progress": consultation["progress"],
-                    "current_step": consultation["current_step"],
-                    "result": consultation.get("result")
-                }
+                return consultation_snapshot(session_id, consultation)
             else:
                 return {"error": "Session not found"}, 404
                 
@@ -150,101 +411,79 @@ async def get_consultation_progress(session_id: str):
 async def stream_consultation_progress(session_id: str):
     """Stream consultation progress using Server-Sent Events"""
     async def generate():
+        # Subscribe before taking the snapshot so no update falls in between
+        pubsub = redis_client.pubsub()
+        await pubsub.subscribe(events_channel(session_id))
         try:
+            consultation = await load_session(session_id)
+            if consultation is None:
+                yield f"data: {json.dumps({'error': 'Session not found'})}\n\n"
+                return
+            
+            data = consultation_snapshot(session_id, consultation)
+            yield f"data: {json.dumps(data)}\n\n"
+            if data["status"] in TERMINAL_STATUSES:
+                return
+            
             while True:
-                if session_id in active_consultations:
-                    consultation = active_consultations[session_id]
-                    
-                    # Send progress update
-                    data = {
-                        "session_id": session_id,
-                        "status": consultation["status"],
-                        "progress": consultation["progress"],
-                        "current_step": consultation["current_step"],
-                        "result": consultation.get("result")
-                    }
-                    
-                    yield f"data: {json.dumps(data)}\n\n"
-                    
-                    # If completed, send final result and break
-                    if consultation["status"] == "completed":
-                        break
-                        
-                    await asyncio.sleep(1)  # Update every second
-                else:
-                    # Session not found
-                    yield f"data: {json.dumps({'error': 'Session not found'})}\n\n"
+                message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=30)
+                if message is None:
+                    yield ": keepalive\n\n"
+                    continue
+                
+                yield f"data: {message['data']}\n\n"
+                if json.loads(message["data"]).get("status") in TERMINAL_STATUSES:
                     break
                     
         except Exception as e:
             logger.error(f"Error streaming consultation progress: {str(e)}")
             yield f"data: {json.dumps({'error': str(e)})}\n\n"
+        finally:
+            await pubsub.unsubscribe()
+            await pubsub.aclose()
     
-    return StreamingResponse(generate(), media_type="text/plain")
+    return StreamingResponse(generate(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
 
-async def process_consultation(session_id: str, question: str, model: str):
+async def process_consultation(session_id: str, question: str, model: str, embedding: Optional[List[float]] = None):
     """Process medical consultation in background"""
+    # Route workflow progress events through a queue
+    queue = asyncio.Queue()
+    set_progress_queue(session_id, queue)
+    relay = asyncio.create_task(relay_progress(session_id, queue))
     try:
-        # Set up progress callback
-        def progress_callback(progress: float, step: str):
-            if session_id in active_consultations:
-                active_consultations[session_id]["progress"] = progress
-                active_consultations[session_id]["current_step"] = step
-                
-                # Update database
-                asyncio.create_task(
-                    db.consultations.update_one(
-                        {"session_id": session_id},
-                        {"$set": {"progress": progress, "current_step": step}}
-                    )
-                )
-        
-        set_progress_callback(session_id, progress_callback)
-        
         # Run consultation
-        result = await run_medical_consultation(question, model, session_id)
+        try:
+            result = await run_medical_consultation(question, model, session_id)
+        finally:
+            await queue.put(None)
+            await relay
         
         # Update consultation status
-        if session_id in active_consultations:
-            active_consultations[session_id]["status"] = "completed"
-            active_consultations[session_id]["result"] = result
-            active_consultations[session_id]["progress"] = 100.0
-            active_consultations[session_id]["current_step"] = "会诊完成！"
+        await publish_update(session_id, {
+            "status": "completed",
+            "result": result,
+            "progress": 100.0,
+            "current_step": "会诊完成！"
+        })
         
-        # Update database
-        await db.consultations.update_one(
-            {"session_id": session_id},
-            {"$set": {
-                "status": "completed",
-                "result": result,
-                "progress": 100.0,
-                "current_step": "会诊完成！",
-                "end_time": datetime.now()
-            }}
-        )
+        # Persist the finished consultation
+        await save_consultation_record(session_id, time.time_ns())
         
-        # Clean up after a delay
-        await asyncio.sleep(300)  # Keep in memory for 5 minutes
-        cleanup_session(session_id)
-        if session_id in active_consultations:
-            del active_consultations[session_id]
+        # Remember the answer for semantically similar questions, unless part of it fell back
+        if embedding and result.get("experts") and not result.get("degraded", True):
+            await store_cached_answer(embedding, question, model, result)
             
     except Exception as e:
         logger.error(f"Error processing consultation {session_id}: {str(e)}")
         
         # Update with error status
-        if session_id in active_consultations:
-            active_consultations[session_id]["status"] = "error"
-            active_consultations[session_id]["result"] = {"error": str(e)}
-        
-        await db.consultations.update_one(
-            {"session_id": session_id},
-            {"$set": {
-                "status": "error",
-                "result": {"error": str(e)},
-                "end_time": datetime.now()
-            }}
-        )
+        try:
+            await publish_update(session_id, {"status": "error", "result": {"error": str(e)}})
+            await save_consultation_record(session_id, time.time_ns())
+        except Exception as save_error:
+            logger.error(f"Error saving failed consultation {session_id}: {str(save_error)}")
+    finally:
+        cleanup_session(session_id)
 
 # Include the router in the main app
 app.include_router(api_router)
@@ -257,6 +496,23 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.on_event("startup")
+async def warm_openai_client():
+    # Build the shared client (and its SSL context) before the first consultation
+    get_async_client()
+
+@app.on_event("startup")
+async def warm_tokenizer_cache():
+    # Load tiktoken encodings in a thread so assessments never fetch them on the event loop
+    await warm_tokenizers(CHEAP_MODEL)
+
+@app.on_event("startup")
+async def create_answer_cache_index():
+    await db.answer_cache.create_index("ts", expireAfterSeconds=ANSWER_CACHE_TTL)
+    await db.answer_cache.create_index([("question", 1), ("model", 1)])
+    await sync_answer_index()
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
-    client.close()
\ No newline at end of file
+    client.close()
+    await redis_client.aclose()
\ No newline at end of file
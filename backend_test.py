@@ -4,24 +4,36 @@ Comprehensive Backend API Testing for Multi-Agent Medical Consultation System
 Tests all API endpoints including real-time consultation workflow
 """
 
-import requests
-import json
+import httpx
+import asyncio
+import orjson
+import fastjsonschema
 import time
+import array
 import sys
 import os
+import re
+from functools import lru_cache
+from pathlib import Path
 from datetime import datetime
 import uuid
+import secrets
+import queue
+import threading
+import logging
+import logging.handlers
+
+BACKEND_URL_PATTERN = re.compile(r'^REACT_APP_BACKEND_URL=(.*)$', re.M)
 
 # Get backend URL from frontend .env file
+@lru_cache(maxsize=1)
 def get_backend_url():
     try:
-        with open('/app/frontend/.env', 'r') as f:
-            for line in f:
-                if line.startswith('REACT_APP_BACKEND_URL='):
-                    return line.split('=', 1)[1].strip()
+        match = BACKEND_URL_PATTERN.search(Path('/app/frontend/.env').read_text())
     except Exception as e:
         print(f"Error reading frontend .env: {e}")
         return None
+    return match.group(1).strip() if match else None
 
 BACKEND_URL = get_backend_url()
 if not BACKEND_URL:
@@ -31,37 +43,141 @@ if not BACKEND_URL:
 API_BASE = f"{BACKEND_URL}/api"
 print(f"🔗 Testing backend at: {API_BASE}")
 
+# Progress polling backs off from MIN to MAX seconds while nothing changes
+MIN_POLL_DELAY = 0.25
+MAX_POLL_DELAY = 4.0
+
+JSON_HEADERS = {'Content-Type': 'application/json'}
+
+# Endpoint paths, relative to API_BASE
+URL_ROOT = "/"
+URL_STATUS = "/status"
+URL_START = "/consultation/start"
+URL_START_BATCH = "/consultation/start_batch"
+URL_PROGRESS_MANY = "/consultation/progress"
+URL_SESSION_PROGRESS = "/consultation/{session_id}/progress"
+URL_SESSION_STREAM = "/consultation/{session_id}/stream"
+
+# Bad request or validation error
+INVALID_REQUEST_STATUSES = frozenset({400, 422})
+
+def looks_like_error_payload(data):
+    """Whether a body reports an error, as {"error": ...} or the [{"error": ...}, status_code] pair"""
+    if isinstance(data, list) and len(data) == 2:
+        data = data[0]
+    return isinstance(data, dict) and "error" in data
+
+# How a non-existent session may be reported: status code -> (body check, message)
+NOT_FOUND_HANDLERS = {
+    404: (lambda data: True, "Properly handled non-existent session"),
+    200: (looks_like_error_payload, "Properly handled non-existent session with error response"),
+}
+
+# Request bodies, encoded once and reused for every POST
+# Use the Chinese medical question from the review request
+CONSULTATION_PAYLOAD = orjson.dumps({
+    "question": "3岁男孩反复咳嗽2个月，夜间加重，运动后气促，既往有湿疹史，请问可能的诊断是什么？",
+    "model": "gpt-4o-mini"
+})
+CONCURRENT_PAYLOAD = orjson.dumps({
+    "question": "患者出现发热、咳嗽症状，请协助诊断。",
+    "model": "gpt-4o-mini"
+})
+
+# Response shapes, compiled once
+validate_start = fastjsonschema.compile({
+    "type": "object",
+    "required": ["session_id", "status"],
+    "properties": {
+        "session_id": {"type": "string"},
+        "status": {"type": "string"}
+    }
+})
+validate_progress = fastjsonschema.compile({
+    "type": "object",
+    "required": ["progress", "current_step"],
+    "properties": {
+        "progress": {"type": "number"},
+        "current_step": {"type": "string"},
+        "status": {"type": "string"},
+        "result": {}
+    }
+})
+
+logger = logging.getLogger("backend_test")
+logger.setLevel(logging.INFO)
+logger.propagate = False
+
 class BackendTester:
     def __init__(self):
-        self.session = requests.Session()
-        self.session.headers.update({
-            'Content-Type': 'application/json',
-            'Accept': 'application/json'
-        })
-        self.test_results = []
+        # Output is queued and written by a listener thread, off the polling path
+        log_queue = queue.Queue(-1)
+        self._log_handler = logging.handlers.QueueHandler(log_queue)
+        logger.addHandler(self._log_handler)
+        self._log_listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler(sys.stdout))
+        self._log_listener.start()
         
+        # One pooled HTTP/2 connection to the backend, multiplexing every request
+        self.client = httpx.Client(
+            base_url=API_BASE,
+            http2=True,
+            timeout=httpx.Timeout(10.0, connect=5.0),
+            limits=httpx.Limits(max_keepalive_connections=16, keepalive_expiry=30),
+            headers={'Accept': 'application/json'}
+        )
+        # Test results, one column per field
+        self._names = []
+        self._msgs = []
+        self._details = []
+        self._success = bytearray()
+        # Nanoseconds since the run started, turned into wall-clock time only when reported
+        self._start_wall = time.time()
+        self._t0 = time.monotonic_ns()
+        self._ts = array.array('q')
+        
+    def _get_json(self, path, timeout=httpx.USE_CLIENT_DEFAULT):
+        """GET a path, returning the response and its decoded JSON body when successful"""
+        response = self.client.get(path, timeout=timeout)
+        return response, orjson.loads(response.content) if response.status_code == 200 else None
+    
+    def _post_json(self, path, payload):
+        """POST a JSON payload, returning the response and its decoded JSON body when successful"""
+        return self._post_body(path, orjson.dumps(payload))
+    
+    def _post_body(self, path, body):
+        """POST an already encoded JSON body, returning the response and its decoded JSON body when successful"""
+        response = self.client.post(path, content=body, headers=JSON_HEADERS)
+        return response, orjson.loads(response.content) if response.status_code == 200 else None
+    
+    def _timestamp(self, i):
+        """Wall-clock ISO time of the i-th test result"""
+        return datetime.fromtimestamp(self._start_wall + self._ts[i] / 1e9).isoformat()
+    
+    def close(self):
+        """Close the HTTP client and flush pending output"""
+        self.client.close()
+        self._log_listener.stop()
+        logger.removeHandler(self._log_handler)
+    
     def log_test(self, test_name, success, message, details=None):
         """Log test results"""
         status = "✅ PASS" if success else "❌ FAIL"
-        print(f"{status} {test_name}: {message}")
+        logger.info(f"{status} {test_name}: {message}")
         if details:
-            print(f"   Details: {details}")
+            logger.info(f"   Details: {details}")
         
-        self.test_results.append({
-            'test': test_name,
-            'success': success,
-            'message': message,
-            'details': details,
-            'timestamp': datetime.now().isoformat()
-        })
+        self._names.append(test_name)
+        self._msgs.append(message)
+        self._details.append(details)
+        self._success.append(1 if success else 0)
+        self._ts.append(time.monotonic_ns() - self._t0)
     
     def test_health_check(self):
         """Test basic health check endpoint"""
         try:
-            response = self.session.get(f"{API_BASE}/")
+            response, data = self._get_json(URL_ROOT)
             
             if response.status_code == 200:
-                data = response.json()
                 if "message" in data and "Medical Consultation" in data["message"]:
                     self.log_test("Health Check", True, "API is responding correctly")
                     return True
@@ -80,18 +196,16 @@ class BackendTester:
         """Test status check endpoints"""
         try:
             # Test POST /status
-            test_data = {"client_name": "test_client_" + str(uuid.uuid4())[:8]}
-            response = self.session.post(f"{API_BASE}/status", json=test_data)
+            test_data = {"client_name": "test_client_" + secrets.token_hex(4)}
+            response, data = self._post_json(URL_STATUS, test_data)
             
             if response.status_code == 200:
-                data = response.json()
                 if "id" in data and "client_name" in data:
                     self.log_test("POST Status", True, "Status creation successful")
                     
                     # Test GET /status
-                    get_response = self.session.get(f"{API_BASE}/status")
+                    get_response, status_list = self._get_json(URL_STATUS)
                     if get_response.status_code == 200:
-                        status_list = get_response.json()
                         if isinstance(status_list, list):
                             self.log_test("GET Status", True, f"Retrieved {len(status_list)} status records")
                             return True
@@ -115,25 +229,19 @@ class BackendTester:
     def test_consultation_start(self):
         """Test consultation start endpoint"""
         try:
-            # Use the Chinese medical question from the review request
-            consultation_data = {
-                "question": "3岁男孩反复咳嗽2个月，夜间加重，运动后气促，既往有湿疹史，请问可能的诊断是什么？",
-                "model": "gpt-4o-mini"
-            }
-            
-            response = self.session.post(f"{API_BASE}/consultation/start", json=consultation_data)
+            response, data = self._post_body(URL_START, CONSULTATION_PAYLOAD)
             
             if response.status_code == 200:
-                data = response.json()
-                if "session_id" in data and "status" in data:
-                    if data["status"] == "started":
-                        self.log_test("Consultation Start", True, f"Session started: {data['session_id']}")
-                        return data["session_id"]
-                    else:
-                        self.log_test("Consultation Start", False, f"Unexpected status: {data['status']}", data)
-                        return None
+                try:
+                    validate_start(data)
+                except fastjsonschema.JsonSchemaException as e:
+                    self.log_test("Consultation Start", False, f"Invalid start response: {e.message}", data)
+                    return None
+                if data["status"] == "started":
+                    self.log_test("Consultation Start", True, f"Session started: {data['session_id']}")
+                    return data["session_id"]
                 else:
-                    self.log_test("Consultation Start", False, "Missing required fields", data)
+                    self.log_test("Consultation Start", False, f"Unexpected status: {data['status']}", data)
                     return None
             else:
                 self.log_test("Consultation Start", False, f"HTTP {response.status_code}", response.text)
@@ -143,6 +251,83 @@ class BackendTester:
             self.log_test("Consultation Start", False, f"Error: {str(e)}")
             return None
     
+    def _poll_progress(self, session_id, deadline):
+        """Yield progress snapshots by polling until the deadline, backing off while nothing changes"""
+        progress_url = URL_SESSION_PROGRESS.format(session_id=session_id)
+        delay = MIN_POLL_DELAY
+        previous = None
+        while True:
+            # Each poll gets whatever is left of the monitor window as its timeout
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            response, data = self._get_json(progress_url, timeout=min(5.0, remaining))
+            if response.status_code != 200:
+                raise RuntimeError(f"HTTP {response.status_code}: {response.text}")
+            yield data
+            
+            current = (data.get("progress"), data.get("current_step"))
+            delay = min(delay * 2, MAX_POLL_DELAY) if current == previous else MIN_POLL_DELAY
+            previous = current
+            time.sleep(max(0.0, min(delay, deadline - time.monotonic())))
+    
+    def _read_stream(self, session_id, timeout, events, stop):
+        """Push SSE progress snapshots onto a queue: first whether the stream is available, None once it ends"""
+        try:
+            with self.client.stream("GET", URL_SESSION_STREAM.format(session_id=session_id),
+                                    headers={'Accept': 'text/event-stream'}, timeout=timeout) as response:
+                stream_available = (response.status_code == 200 and
+                                    response.headers.get('Content-Type', '').startswith('text/event-stream'))
+                events.put(stream_available)
+                if not stream_available:
+                    return
+                for line in response.iter_lines():
+                    if stop.is_set():
+                        return
+                    if not line or not line.startswith('data:'):
+                        continue
+                    data = orjson.loads(line[len('data:'):])
+                    if data.get("type") != "token":
+                        events.put(data)
+        except httpx.ReadTimeout:
+            pass
+        except Exception as e:
+            events.put(e)
+        finally:
+            events.put(None)
+    
+    def _stream_progress(self, session_id, monitor_duration):
+        """Yield progress snapshots pushed over SSE, falling back to polling if the stream is unavailable"""
+        deadline = time.monotonic() + monitor_duration
+        timeout = httpx.Timeout(monitor_duration, connect=min(10.0, monitor_duration))
+        events = queue.Queue()
+        stop = threading.Event()
+        # Keepalives reset the read timeout, so the stream is read on a thread and each wait is bounded by the deadline
+        threading.Thread(target=self._read_stream, args=(session_id, timeout, events, stop), daemon=True).start()
+        try:
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                try:
+                    event = events.get(timeout=remaining)
+                except queue.Empty:
+                    return
+                if event is None:
+                    return
+                if event is True:
+                    continue
+                if event is False:
+                    yield from self._poll_progress(session_id, deadline)
+                    return
+                if isinstance(event, Exception):
+                    raise event
+                yield event
+                if event.get("status") in ("completed", "error"):
+                    return
+        finally:
+            stop.set()
+    
     def test_consultation_progress(self, session_id, monitor_duration=60):
         """Test consultation progress monitoring"""
         if not session_id:
@@ -150,62 +335,53 @@ class BackendTester:
             return False
             
         try:
-            print(f"📊 Monitoring progress for session {session_id} for {monitor_duration} seconds...")
+            logger.info(f"📊 Monitoring progress for session {session_id} for {monitor_duration} seconds...")
             start_time = time.time()
             last_progress = -1
             progress_updates = []
             
-            while time.time() - start_time < monitor_duration:
-                response = self.session.get(f"{API_BASE}/consultation/{session_id}/progress")
+            for data in self._stream_progress(session_id, monitor_duration):
+                try:
+                    validate_progress(data)
+                except fastjsonschema.JsonSchemaException as e:
+                    self.log_test("Progress Monitoring", False, f"Invalid progress response: {e.message}", data)
+                    return False
                 
-                if response.status_code == 200:
-                    data = response.json()
-                    
-                    if "progress" in data and "current_step" in data:
-                        current_progress = data["progress"]
-                        current_step = data["current_step"]
-                        status = data.get("status", "unknown")
-                        
-                        # Log progress updates
-                        if current_progress != last_progress:
-                            print(f"   Progress: {current_progress:.1f}% - {current_step}")
-                            progress_updates.append({
-                                'progress': current_progress,
-                                'step': current_step,
-                                'status': status,
-                                'timestamp': time.time() - start_time
-                            })
-                            last_progress = current_progress
-                        
-                        # Check if completed
-                        if status == "completed":
-                            result = data.get("result")
-                            if result:
-                                self.log_test("Progress Monitoring", True, 
-                                            f"Consultation completed in {time.time() - start_time:.1f}s",
-                                            f"Final result contains {len(result.get('experts', []))} experts")
-                                self.log_test("Consultation Workflow", True, 
-                                            "Multi-agent workflow executed successfully",
-                                            f"Progress updates: {len(progress_updates)}")
-                                return True
-                            else:
-                                self.log_test("Progress Monitoring", False, "Completed but no result")
-                                return False
-                        
-                        # Check for errors
-                        if status == "error":
-                            error_msg = data.get("result", {}).get("error", "Unknown error")
-                            self.log_test("Progress Monitoring", False, f"Consultation failed: {error_msg}")
-                            return False
-                            
+                current_progress = data["progress"]
+                current_step = data["current_step"]
+                status = data.get("status", "unknown")
+                
+                # Log progress updates
+                if current_progress != last_progress:
+                    logger.info("   Progress: %.1f%% - %s", current_progress, current_step)
+                    progress_updates.append({
+                        'progress': current_progress,
+                        'step': current_step,
+                        'status': status,
+                        'timestamp': time.time() - start_time
+                    })
+                    last_progress = current_progress
+                
+                # Check if completed
+                if status == "completed":
+                    result = data.get("result")
+                    if result:
+                        self.log_test("Progress Monitoring", True, 
+                                    f"Consultation completed in {time.time() - start_time:.1f}s",
+                                    f"Final result contains {len(result.get('experts', []))} experts")
+                        self.log_test("Consultation Workflow", True, 
+                                    "Multi-agent workflow executed successfully",
+                                    f"Progress updates: {len(progress_updates)}")
+                        return True
                     else:
-                        self.log_test("Progress Monitoring", False, "Missing progress fields", data)
+                        self.log_test("Progress Monitoring", False, "Completed but no result")
                         return False
-                else:
-                    self.log_test("Progress Monitoring", False, f"HTTP {response.status_code}", response.text)
-                    return False
                 
-                time.sleep(2)  # Check every 2 seconds
+                # Check for errors
+                if status == "error":
+                    error_msg = (data.get("result") or {}).get("error", "Unknown error")
+                    self.log_test("Progress Monitoring", False, f"Consultation failed: {error_msg}")
+                    return False
             
             # If we reach here, monitoring timed out
             if progress_updates:
@@ -226,9 +402,9 @@ class BackendTester:
         try:
             # Test invalid consultation request
             invalid_data = {"invalid_field": "test"}
-            response = self.session.post(f"{API_BASE}/consultation/start", json=invalid_data)
+            response, _ = self._post_json(URL_START, invalid_data)
             
-            if response.status_code in [400, 422]:  # Bad request or validation error
+            if response.status_code in INVALID_REQUEST_STATUSES:
                 self.log_test("Invalid Request Handling", True, "Properly rejected invalid consultation request")
             else:
                 self.log_test("Invalid Request Handling", False, 
@@ -236,73 +412,99 @@ class BackendTester:
             
             # Test non-existent session progress
             fake_session_id = str(uuid.uuid4())
-            response = self.session.get(f"{API_BASE}/consultation/{fake_session_id}/progress")
+            response, data = self._get_json(URL_SESSION_PROGRESS.format(session_id=fake_session_id))
+            
+            handler = NOT_FOUND_HANDLERS.get(response.status_code)
+            if handler is None:
+                self.log_test("Non-existent Session", False, 
+                            f"Should return 404 or error, got HTTP {response.status_code}")
+                return False
             
-            if response.status_code == 404:
-                self.log_test("Non-existent Session", True, "Properly handled non-existent session")
+            check, message = handler
+            if check(data):
+                self.log_test("Non-existent Session", True, message)
                 return True
-            elif response.status_code == 200:
-                data = response.json()
-                # Check if it's the expected error format [{"error": "message"}, status_code]
-                if isinstance(data, list) and len(data) == 2 and isinstance(data[0], dict) and "error" in data[0]:
-                    self.log_test("Non-existent Session", True, "Properly handled non-existent session with error response")
-                    return True
-                elif isinstance(data, dict) and "error" in data:
-                    self.log_test("Non-existent Session", True, "Properly handled non-existent session with error response")
-                    return True
-                else:
-                    self.log_test("Non-existent Session", False, 
-                                f"Unexpected response format for non-existent session", data)
-                    return False
             else:
                 self.log_test("Non-existent Session", False, 
-                            f"Should return 404 or error, got HTTP {response.status_code}")
+                            f"Unexpected response format for non-existent session", data)
                 return False
                 
         except Exception as e:
             self.log_test("Error Handling", False, f"Error: {str(e)}")
             return False
     
-    def test_concurrent_sessions(self):
+    async def _start_batch(self, client, body, n):
+        """Start n sessions from one encoded request body in a single batch request, falling back to one request each"""
+        batch = b'{"items":[' + b','.join([body] * n) + b']}'
+        response = await client.post(URL_START_BATCH, content=batch, headers=JSON_HEADERS)
+        if response.status_code == 200:
+            data = orjson.loads(response.content)
+            return data.get("session_ids", []) if isinstance(data, dict) else []
+        if response.status_code != 404:
+            return []
+        
+        responses = await asyncio.gather(
+            *[client.post(URL_START, content=body, headers=JSON_HEADERS) for _ in range(n)],
+            return_exceptions=True
+        )
+        sessions = []
+        for response in responses:
+            if isinstance(response, Exception) or response.status_code != 200:
+                continue
+            data = orjson.loads(response.content)
+            if "session_id" in data:
+                sessions.append(data["session_id"])
+        return sessions
+    
+    async def _progress_many(self, client, session_ids):
+        """Fetch the progress of several sessions in one request, falling back to one request each"""
+        response = await client.get(URL_PROGRESS_MANY, params={"ids": ",".join(session_ids)})
+        if response.status_code == 200:
+            data = orjson.loads(response.content)
+            return data if isinstance(data, dict) else {}
+        if response.status_code != 404:
+            return {}
+        
+        responses = await asyncio.gather(
+            *[client.get(URL_SESSION_PROGRESS.format(session_id=session_id)) for session_id in session_ids],
+            return_exceptions=True
+        )
+        progress = {}
+        for session_id, response in zip(session_ids, responses):
+            if isinstance(response, Exception) or response.status_code != 200:
+                continue
+            data = orjson.loads(response.content)
+            if isinstance(data, dict):
+                progress[session_id] = data
+        return progress
+    
+    async def test_concurrent_sessions(self, n=10):
         """Test multiple concurrent consultation sessions"""
         try:
-            print("🔄 Testing concurrent sessions...")
+            logger.info(f"🔄 Testing {n} concurrent sessions...")
             
-            # Start multiple sessions
-            sessions = []
-            consultation_data = {
-                "question": "患者出现发热、咳嗽症状，请协助诊断。",
-                "model": "gpt-4o-mini"
-            }
-            
-            for i in range(2):  # Test 2 concurrent sessions
-                response = self.session.post(f"{API_BASE}/consultation/start", json=consultation_data)
-                if response.status_code == 200:
-                    data = response.json()
-                    if "session_id" in data:
-                        sessions.append(data["session_id"])
-                        print(f"   Started session {i+1}: {data['session_id']}")
-            
-            if len(sessions) >= 2:
-                # Check that both sessions are progressing
-                time.sleep(5)  # Wait a bit for processing to start
-                
-                working_sessions = 0
-                for session_id in sessions:
-                    response = self.session.get(f"{API_BASE}/consultation/{session_id}/progress")
-                    if response.status_code == 200:
-                        data = response.json()
-                        if data.get("progress", 0) > 0:
-                            working_sessions += 1
+            limits = httpx.Limits(max_connections=n * 2, max_keepalive_connections=n)
+            async with httpx.AsyncClient(base_url=API_BASE, http2=True, limits=limits, timeout=30.0) as client:
+                # Start all sessions at once
+                sessions = await self._start_batch(client, CONCURRENT_PAYLOAD, n)
+                for i, session_id in enumerate(sessions):
+                    logger.info(f"   Started session {i+1}: {session_id}")
                 
-                if working_sessions >= 2:
-                    self.log_test("Concurrent Sessions", True, f"Successfully handling {working_sessions} concurrent sessions")
-                    return True
-                else:
-                    self.log_test("Concurrent Sessions", False, f"Only {working_sessions} sessions working")
+                if len(sessions) < n:
+                    self.log_test("Concurrent Sessions", False, f"Could only start {len(sessions)} of {n} sessions")
                     return False
+                
+                # Check that all sessions are progressing
+                await asyncio.sleep(5)  # Wait a bit for processing to start
+                
+                results = await self._progress_many(client, sessions)
+                working_sessions = sum(1 for data in results.values() if data.get("progress", 0) > 0)
+            
+            if working_sessions >= n:
+                self.log_test("Concurrent Sessions", True, f"Successfully handling {working_sessions} concurrent sessions")
+                return True
             else:
-                self.log_test("Concurrent Sessions", False, f"Could only start {len(sessions)} sessions")
+                self.log_test("Concurrent Sessions", False, f"Only {working_sessions} of {n} sessions working")
                 return False
                 
         except Exception as e:
@@ -311,12 +513,12 @@ class BackendTester:
     
     def run_all_tests(self):
         """Run all backend tests"""
-        print("🚀 Starting comprehensive backend API testing...")
-        print("=" * 60)
+        logger.info("🚀 Starting comprehensive backend API testing...")
+        logger.info("=" * 60)
         
         # Test 1: Basic connectivity
         if not self.test_health_check():
-            print("❌ Basic connectivity failed. Stopping tests.")
+            logger.info("❌ Basic connectivity failed. Stopping tests.")
             return False
         
         # Test 2: Status endpoints
@@ -332,33 +534,36 @@ class BackendTester:
         self.test_invalid_requests()
         
         # Test 5: Concurrent sessions
-        self.test_concurrent_sessions()
+        asyncio.run(self.test_concurrent_sessions())
         
         # Summary
-        print("\n" + "=" * 60)
-        print("📊 TEST SUMMARY")
-        print("=" * 60)
+        logger.info("\n" + "=" * 60)
+        logger.info("📊 TEST SUMMARY")
+        logger.info("=" * 60)
         
-        total_tests = len(self.test_results)
-        passed_tests = sum(1 for result in self.test_results if result['success'])
+        total_tests = len(self._success)
+        passed_tests = self._success.count(1)
         failed_tests = total_tests - passed_tests
         
-        print(f"Total Tests: {total_tests}")
-        print(f"Passed: {passed_tests}")
-        print(f"Failed: {failed_tests}")
-        print(f"Success Rate: {(passed_tests/total_tests)*100:.1f}%")
+        logger.info(f"Total Tests: {total_tests}")
+        logger.info(f"Passed: {passed_tests}")
+        logger.info(f"Failed: {failed_tests}")
+        logger.info(f"Success Rate: {(passed_tests/total_tests)*100:.1f}%")
         
         if failed_tests > 0:
-            print("\n❌ FAILED TESTS:")
-            for result in self.test_results:
-                if not result['success']:
-                    print(f"   - {result['test']}: {result['message']}")
+            logger.info("\n❌ FAILED TESTS:")
+            for i, ok in enumerate(self._success):
+                if not ok:
+                    logger.info(f"   - {self._names[i]}: {self._msgs[i]} ({self._timestamp(i)})")
         
         return failed_tests == 0
 
 if __name__ == "__main__":
     tester = BackendTester()
-    success = tester.run_all_tests()
+    try:
+        success = tester.run_all_tests()
+    finally:
+        tester.close()
     
     if success:
         print("\n🎉 All tests passed! Backend is working correctly.")